@@ -5,6 +5,8 @@ SHOULD_DELETE = True
 RCLONE_PATH = '/usr/bin/rclone'
 RCLONE_CONFIG_PATH = '/mnt/vdb/rclone.conf'
 MAX_UPLOAD_TRIES = 3
+# Extra flags for rclone uploads (parallel transfers and bigger chunks speed up GDrive uploads).
+RCLONE_UPLOAD_FLAGS = ['--fast-list', '--transfers=10', '--checkers=20', '--drive-chunk-size=128M']
 
 # encfs settings.
 SHOULD_ENCRYPT = True
@@ -1,4 +1,5 @@
 #!/usr/local/bin/python3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
 from pathlib import Path
 import shutil
@@ -11,6 +12,9 @@ GDRIVE_ROOT_PATH = '/mnt/vdb/rclone/gdrive_decrypted'
 FAKE_ROOT_PATH = '/mnt/vdb/sonarr/fake'
 LOG_FILE_PATH = '/var/log/sonarr_faker/sonarr_faker.log'
 
+# The amount of directories handled in parallel.
+MAX_WORKERS = 8
+
 logger = logbook.Logger(__name__)
 
 
@@ -27,6 +31,45 @@ def _get_log_handlers():
     ]
 
 
+def _scan_dir(root):
+    """
+    Scan the given directory using os.scandir, so no extra stat calls are needed per entry.
+
+    :param root: The directory to scan.
+    :return: A tuple of format (file_names, sub_dirs).
+    """
+    file_names = []
+    sub_dirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_dirs.append(entry.path)
+            elif entry.is_file():
+                file_names.append(entry.name)
+    return file_names, sub_dirs
+
+
+def _handle_dir(root):
+    """
+    Create a fake directory for the given directory, with a fake file for each of its files.
+
+    :param root: The directory to fake.
+    :return: The sub directories list of the given directory.
+    """
+    logger.info(f'Handling dir: {root}')
+    files, sub_dirs = _scan_dir(root)
+    # Create a fake directory.
+    fake_root = root.replace(GDRIVE_ROOT_PATH, FAKE_ROOT_PATH, 1)
+    os.makedirs(fake_root, exist_ok=True)
+
+    for f in files:
+        # Create a fake file.
+        fake_path = os.path.join(fake_root, f)
+        Path(fake_path).touch()
+
+    return sub_dirs
+
+
 def main():
     """
     Go over the entire TV collection, and create fake files in a writable directory, so Sonarr would scan them.
@@ -43,17 +86,21 @@ def main():
             logger.info('Deleting previous fake directory...')
             shutil.rmtree(FAKE_ROOT_PATH)
 
-        # Start working!
-        for root, dirs, files in os.walk(GDRIVE_ROOT_PATH):
-            logger.info(f'Handling dir: {root}')
-            # Create a fake directory.
-            fake_root = root.replace(GDRIVE_ROOT_PATH, FAKE_ROOT_PATH)
-            os.makedirs(fake_root, exist_ok=True)
-
-            for f in files:
-                # Create a fake file.
-                fake_path = os.path.join(fake_root, f)
-                Path(fake_path).touch()
+        # Start working! Directories are listed in parallel, since every listing is a round-trip to GDrive.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(_handle_dir, GDRIVE_ROOT_PATH): GDRIVE_ROOT_PATH}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root = futures.pop(future)
+                    try:
+                        sub_dirs = future.result()
+                    except Exception:
+                        # Catch all exceptions so the script won't stop.
+                        logger.exception(f'Failed to handle dir: {root}')
+                        continue
+                    for sub_dir in sub_dirs:
+                        futures[executor.submit(_handle_dir, sub_dir)] = sub_dir
 
         logger.info('All done!')
 
@@ -1,22 +1,21 @@
 #!/usr/local/bin/python3
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import suppress
 import datetime
+from functools import lru_cache
 import os
 import sys
+import threading
 import time
 
 import babelfish
 from guessit import guessit
 import logbook
-from plexapi.server import PlexServer
 import requests
-from showsformatter import format_show
-import subliminal
-from subliminal.cache import region
-from subliminal.subtitle import get_subtitle_path
 
 from clouduploader import config
-from clouduploader.uploader import guess_path, upload_file
+from clouduploader.uploader import format_show_title, guess_path, upload_files
 
 # Ignore SSL warnings.
 requests.packages.urllib3.disable_warnings()
@@ -37,15 +36,30 @@ PROVIDER_CONFIGS = {
     }
 }
 
+# The memcached server to use for the subliminal cache (or None for an in-memory cache).
+MEMCACHED_URL = None
+
 # The monitor will look only at the latest X files (or all of them if RESULTS_LIMIT is None).
 RESULTS_LIMIT = 1000
+# The amount of videos handled in parallel.
+MAX_WORKERS = 8
 
 SUBTITLES_EXTENSION = '.srt'
 LANGUAGE_EXTENSIONS = ['.he', '.en']
+# A map between each language extension and its language.
+LANGUAGE_MAP = {extension: babelfish.Language.fromalpha2(extension.lstrip('.')) for extension in LANGUAGE_EXTENSIONS}
 LOG_FILE_PATH = '/var/log/subtitles_monitor.log'
+# A list of the videos which already had all of their subtitles, so they won't be checked again.
+# It's rewritten on every run, keeping only videos which are still within the latest RESULTS_LIMIT files.
+# To search for new subtitles for a completed video, remove its line from this file.
+COMPLETED_NAMES_LOG = '/mnt/vdb/subtitles_completed.log'
 
 logger = logbook.Logger(__name__)
 
+# The current paths of the videos already handled in this run (different releases may map to the same video).
+_handled_paths = set()
+_handled_paths_lock = threading.Lock()
+
 
 def _get_log_handlers():
     """
@@ -64,9 +78,23 @@ def _get_log_handlers():
 def configure_subtitles_cache():
     """
     Configure the subliminal cache settings.
+    A memcached server is used if configured (so the cache is kept between runs), and an in-memory cache otherwise.
     Should be called once when the program starts.
     """
-    region.configure('dogpile.cache.memory', expiration_time=datetime.timedelta(days=7))
+    # Subliminal is imported lazily, since it loads all of its providers on import.
+    from subliminal.cache import region
+
+    expiration_time = datetime.timedelta(days=7)
+    if MEMCACHED_URL:
+        try:
+            import pymemcache  # noqa: F401
+        except ImportError:
+            logger.warning('pymemcache is not installed! Using an in-memory cache instead...')
+        else:
+            region.configure('dogpile.cache.pymemcache', expiration_time=expiration_time,
+                             arguments={'url': MEMCACHED_URL})
+            return
+    region.configure('dogpile.cache.memory', expiration_time=expiration_time)
 
 
 def refresh_plex_item(title, season=None, episodes=None):
@@ -77,6 +105,8 @@ def refresh_plex_item(title, season=None, episodes=None):
     :param season: The season number.
     :param episodes: The episode numbers list.
     """
+    from plexapi.server import PlexServer
+
     logger.info('Updating Plex...')
     is_episode = season is not None and episodes is not None
     for base_url, token in config.PLEX_SERVERS:
@@ -99,59 +129,195 @@ def refresh_plex_item(title, season=None, episodes=None):
                     title, episode_details if is_episode else ''))
 
 
-def find_file_subtitles(original_path, current_path, language):
+def _tail_lines(file_path, lines_num, block_size=8192):
+    """
+    Read the last lines of the given file, like "tail -n" does.
+    The file is read backwards in blocks, so only the relevant end of it is read from disk.
+
+    :param file_path: The file to read.
+    :param lines_num: The amount of lines to read (or None for all lines).
+    :param block_size: The size of each block read from the file.
+    :return: The list of non-empty lines (stripped), from oldest to newest.
+    """
+    with open(file_path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        blocks = []
+        newlines_count = 0
+        # Stop once a full extra line was read, since the first line of the data is probably partial.
+        while position > 0 and (lines_num is None or newlines_count <= lines_num):
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size)
+            blocks.append(block)
+            newlines_count += block.count(b'\n')
+
+    lines = b''.join(reversed(blocks)).split(b'\n')
+    if position > 0:
+        # Drop the partial first line.
+        lines = lines[1:]
+    lines = [line.decode('utf8').strip() for line in lines]
+    lines = [line for line in lines if line]
+    return lines[-lines_num:] if lines_num else lines
+
+
+@lru_cache(maxsize=None)
+def _list_dir(dir_path):
+    """
+    List the file names in the given directory.
+    Results are cached, so videos in the same directory (like episodes of a season) share a single listing.
+
+    :param dir_path: The directory to list.
+    :return: A set of the file names in the directory (empty if it doesn't exist).
+    """
+    try:
+        with os.scandir(dir_path) as entries:
+            return frozenset(entry.name for entry in entries if entry.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return frozenset()
+
+
+def find_file_subtitles(original_path, current_path, languages, video_guess):
     """
-    Finds subtitles for the given video file path in the given language.
-    Downloaded subtitles will be saved next to the video file.
+    Finds subtitles for the given video file path in the given languages.
+    Languages with the same favorite providers are searched together, in a single subliminal request.
+    Downloaded subtitles will be saved in the temporary directory, so they can be uploaded later on.
 
     :param original_path: The original path of the video file to find subtitles to.
     :param current_path: The current video path (to save the subtitles file next to).
-    :param language: The language to search for.
-    :return: The subtitles file path, or None if a problem occurred.
+    :param languages: The languages list to search for.
+    :param video_guess: The guessit results for the original file name.
+    :return: A dict between each language and its subtitles file path (empty if nothing was found).
     """
-    logger.info('Searching {} subtitles for file: {}'.format(language.alpha3, original_path))
+    import subliminal
+    from subliminal.subtitle import get_subtitle_path
+
+    logger.info('Searching {} subtitles for file: {}'.format(
+        ', '.join([language.alpha3 for language in languages]), original_path))
+    subtitles_paths = {}
     try:
-        subtitles_result = None
         original_file_name = os.path.basename(original_path)
         # Get required video information.
-        video = subliminal.Video.fromguess(current_path, guessit(original_file_name))
-        # Try using providers specified by the user.
-        providers = PROVIDERS_MAP.get(language)
-        current_result = subliminal.download_best_subtitles(
-            {video}, languages={language}, providers=providers, provider_configs=PROVIDER_CONFIGS).values()
-        if current_result:
-            current_result = list(current_result)[0]
-            if current_result:
-                subtitles_result = current_result[0]
+        video = subliminal.Video.fromguess(current_path, video_guess)
+        # Group the languages by the providers specified by the user.
+        providers_groups = defaultdict(set)
+        for language in languages:
+            providers = PROVIDERS_MAP.get(language)
+            providers_groups[tuple(providers) if providers is not None else None].add(language)
+        subtitles_results = []
+        for providers, languages_group in providers_groups.items():
+            current_result = subliminal.download_best_subtitles(
+                {video}, languages=languages_group, providers=list(providers) if providers is not None else None,
+                provider_configs=PROVIDER_CONFIGS)
+            subtitles_results.extend(current_result.get(video, []))
         # Handle results.
-        if not subtitles_result:
+        if not subtitles_results:
             logger.info('No subtitles were found. Moving on...')
-        else:
-            logger.info('Subtitles found! Saving files...')
+        for subtitles_result in subtitles_results:
+            logger.info(f'{subtitles_result.language.alpha3} subtitles found! Saving files...')
             # Save subtitles alongside the video file (if they're not empty).
             if subtitles_result.content is None:
                 logger.debug(f'Skipping subtitle {subtitles_result}: no content')
-            else:
-                subtitles_file_name = get_subtitle_path(original_file_name, subtitles_result.language)
-                subtitles_path = os.path.join(TEMP_PATH, subtitles_file_name)
-                logger.info(f'Saving {subtitles_result} to: {subtitles_path}')
-                try:
-                    open(subtitles_path, 'wb').write(subtitles_result.content)
-                    logger.info(f'Uploading {subtitles_path}')
-                    try:
-                        upload_file(subtitles_path)
-                    except Exception:
-                        # Catch all exceptions so the script won't stop.
-                        logger.exception(f'Failed to upload file: {subtitles_path}')
-                except OSError:
-                    logger.error(f'Failed to save subtitles in path: {subtitles_path}')
-                return subtitles_path
-        return None
+                continue
+            subtitles_file_name = get_subtitle_path(original_file_name, subtitles_result.language)
+            subtitles_path = os.path.join(TEMP_PATH, subtitles_file_name)
+            logger.info(f'Saving {subtitles_result} to: {subtitles_path}')
+            # Write to a temporary path first, so a partial file will never be uploaded.
+            temp_subtitles_path = f'{subtitles_path}.tmp'
+            try:
+                with open(temp_subtitles_path, 'wb') as subtitles_file:
+                    subtitles_file.write(subtitles_result.content)
+                os.replace(temp_subtitles_path, subtitles_path)
+                subtitles_paths[subtitles_result.language] = subtitles_path
+            except OSError:
+                logger.error(f'Failed to save subtitles in path: {subtitles_path}')
+                with suppress(FileNotFoundError):
+                    os.remove(temp_subtitles_path)
     except ValueError:
         # Subliminal raises a ValueError if the given file is not a video file.
         logger.info('Not a video file. Moving on...')
     except Exception:
         logger.exception('Error in Subliminal. Moving on...')
+    return subtitles_paths
+
+
+def _get_fixed_file_name(original_path):
+    """
+    Get the fixed file name (for guessing) of the given video file.
+
+    :param original_path: The original path of the video file.
+    :return: A tuple of format (fixed_file_name, file_extension).
+    """
+    fixed_file_name, file_extension = os.path.splitext(os.path.basename(original_path))
+    # Remove brackets group name prefix.
+    if fixed_file_name.startswith('[') and ']' in fixed_file_name:
+        fixed_file_name = fixed_file_name.partition(']')[2]
+    return fixed_file_name, file_extension
+
+
+def _refresh_plex_video(original_path):
+    """
+    Refresh the Plex item of the given video file.
+
+    :param original_path: The original path of the video file.
+    """
+    video_details = guessit(_get_fixed_file_name(original_path)[0])
+    title = video_details['title']
+    season = video_details.get('season')
+    episode = video_details.get('episode')
+
+    if isinstance(title, list):
+        title = title[0]
+
+    # Use the best show title available.
+    if season and episode:
+        title = format_show_title(title)
+    else:
+        title = title.title()
+
+    refresh_plex_item(title, season, [episode] if not isinstance(episode, list) else episode)
+
+
+def _handle_video(original_path):
+    """
+    Find and download the missing subtitles of the given video.
+
+    :param original_path: The original path of the video file.
+    :return: A dict between each language and its downloaded subtitles file path,
+             or None if the video already has all of its subtitles.
+    """
+    fixed_file_name, file_extension = _get_fixed_file_name(original_path)
+
+    cloud_dir, cloud_file = guess_path(fixed_file_name)
+    if not (cloud_dir and cloud_file):
+        return {}
+
+    current_dir = os.path.join(MEDIA_ROOT_PATH, cloud_dir)
+    current_file_name = f'{cloud_file}{file_extension}'
+    current_path = os.path.join(current_dir, current_file_name)
+
+    # Check actual video file.
+    current_dir_files = _list_dir(current_dir)
+    if current_file_name not in current_dir_files:
+        logger.info(f'Couldn\'t find: {current_path}')
+        return {}
+    with _handled_paths_lock:
+        if current_path in _handled_paths:
+            logger.info(f'Already handled: {current_path}')
+            return {}
+        _handled_paths.add(current_path)
+    logger.info(f'Checking subtitles for: {current_path}')
+
+    # Find missing subtitle files (they're next to the video file, and named after it).
+    languages_list = []
+    for language_extension in LANGUAGE_EXTENSIONS:
+        if f'{cloud_file}{language_extension}{SUBTITLES_EXTENSION}' not in current_dir_files:
+            languages_list.append(LANGUAGE_MAP[language_extension])
+
+    # Download missing subtitles.
+    if not languages_list:
+        return None
+    return find_file_subtitles(original_path, current_path, languages_list, guessit(os.path.basename(original_path)))
 
 
 def main():
@@ -168,74 +334,64 @@ def main():
             raise NotADirectoryError('Couldn\'t find media root directory! Stopping...')
 
         try:
-            original_paths_list = []
             subtitles_map = defaultdict(int)
             # Set subliminal cache first.
             logger.debug('Setting subtitles cache...')
             configure_subtitles_cache()
 
             logger.info('Going over the original names file...')
-            with open(config.ORIGINAL_NAMES_LOG, 'r', encoding='utf8') as original_names_file:
-                line = original_names_file.readline()
-                while line:
-                    original_path = line.strip()
-                    original_paths_list.append(original_path)
-                    if RESULTS_LIMIT and len(original_paths_list) > RESULTS_LIMIT:
-                        original_paths_list.pop(0)
-                    # Fetch next line.
-                    line = original_names_file.readline()
+            original_paths_list = _tail_lines(config.ORIGINAL_NAMES_LOG, RESULTS_LIMIT or None)
+            # Skip duplicates (files that were uploaded more than once), so they won't be guessed again.
+            original_paths_list = list(dict.fromkeys(original_paths_list))
+            # Skip videos which already have all of their subtitles (without guessing anything).
+            completed_paths = set()
+            if os.path.isfile(COMPLETED_NAMES_LOG):
+                with open(COMPLETED_NAMES_LOG, 'r', encoding='utf8') as completed_names_file:
+                    completed_paths = {line.strip() for line in completed_names_file}
+            # Videos which left the window are dropped, so the completed list never outgrows it.
+            completed_paths_list = [path for path in original_paths_list if path in completed_paths]
+            original_paths_list = [path for path in original_paths_list if path not in completed_paths]
 
             logger.info(f'Searching for subtitles for the {RESULTS_LIMIT} newest videos...')
-            for original_path in original_paths_list:
-                fixed_file_name, file_extension = os.path.splitext(os.path.basename(original_path))
-                # Remove brackets group name prefix.
-                if fixed_file_name.startswith('[') and ']' in fixed_file_name:
-                    fixed_file_name = fixed_file_name.split(']', 1)[1]
-
-                cloud_dir, cloud_file = guess_path(fixed_file_name)
-                if not (cloud_dir and cloud_file):
-                    continue
-
-                current_path = os.path.join(MEDIA_ROOT_PATH, cloud_dir, f'{cloud_file}{file_extension}')
-
-                # Check actual video file.
-                if current_path and os.path.isfile(current_path):
-                    logger.info(f'Checking subtitles for: {current_path}')
-
-                    # Find missing subtitle files.
-                    video_base_path = os.path.splitext(current_path)[0]
-                    languages_list = []
-                    for language_extension in LANGUAGE_EXTENSIONS:
-                        if not os.path.isfile(video_base_path + language_extension + SUBTITLES_EXTENSION):
-                            languages_list.append(babelfish.Language.fromalpha2(language_extension.lstrip('.')))
-
-                    # Download missing subtitles.
-                    for language in languages_list:
-                        result_path = find_file_subtitles(original_path, current_path, language)
-                        if result_path:
-                            subtitles_map[language.alpha3] += 1
-
-                            # Refresh Plex data (after waiting some time for the file to upload).
-                            if config.PLEX_SERVERS:
-                                video_details = guessit(fixed_file_name)
-                                title = video_details['title']
-                                season = video_details.get('season')
-                                episode = video_details.get('episode')
-
-                                if isinstance(title, list):
-                                    title = title[0]
-
-                                # Use the best show title available.
-                                if season and episode:
-                                    title = format_show(title)
-                                else:
-                                    title = title.title()
-
-                                time.sleep(5)
-                                refresh_plex_item(
-                                    title, season, [episode] if not isinstance(episode, list) else episode)
-                else:
-                    logger.info(f'Couldn\'t find: {current_path}')
+            videos_subtitles = {}
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = {executor.submit(_handle_video, original_path): original_path
+                           for original_path in original_paths_list}
+                for future in as_completed(futures):
+                    try:
+                        subtitles_paths = future.result()
+                    except Exception:
+                        # Catch all exceptions so the script won't stop.
+                        logger.exception(f'Failed to handle video: {futures[future]}')
+                        continue
+                    if subtitles_paths is None:
+                        completed_paths_list.append(futures[future])
+                        continue
+                    if subtitles_paths:
+                        videos_subtitles[futures[future]] = subtitles_paths
+                    for language in subtitles_paths:
+                        subtitles_map[language.alpha3] += 1
+
+            logger.info(f'Saving {len(completed_paths_list)} completed videos...')
+            with open(COMPLETED_NAMES_LOG, 'w', encoding='utf8') as completed_names_file:
+                completed_names_file.writelines(f'{path}\n' for path in completed_paths_list)
+
+            # Upload all downloaded subtitles at once.
+            if videos_subtitles:
+                subtitles_paths_list = [path for paths in videos_subtitles.values() for path in paths.values()]
+                logger.info(f'Uploading {len(subtitles_paths_list)} subtitles files...')
+                try:
+                    upload_files(subtitles_paths_list)
+                except Exception:
+                    # Catch all exceptions so the script won't stop.
+                    logger.exception('Failed to upload subtitles files')
+
+                # Refresh Plex data (after waiting some time for the files to upload).
+                if config.PLEX_SERVERS:
+                    logger.info('Refreshing Plex items...')
+                    time.sleep(5)
+                    for original_path in videos_subtitles:
+                        _refresh_plex_video(original_path)
 
             logger.info('All done! The results are: {}'.format(
                 ', '.join(['{} - {}'.format(language, counter) for language, counter in subtitles_map.items()])))
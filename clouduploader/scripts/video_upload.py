@@ -44,8 +44,9 @@ def _encrypt(encrypted_dir, plain_dir):
 
     # Encrypt!
     os.makedirs(encrypted_dir)
-    return_code = subprocess.call(
-        f'echo {config.ENCFS_PASSWORD} | {config.ENCFS_PATH} -S "{encrypted_dir}" "{plain_dir}"', shell=True)
+    return_code = subprocess.run(
+        [config.ENCFS_PATH, '-S', encrypted_dir, plain_dir], input=f'{config.ENCFS_PASSWORD}\n', text=True,
+        check=False).returncode
 
     if return_code != 0:
         logger.error(f'Bad return code ({return_code}) for encryption. Stopping!')
@@ -86,7 +87,7 @@ def upload_video(file_path):
         # Upload the encrypted directory tree instead of the plain one.
         upload_base_dir = encrypted_base_dir
 
-    gdrive_dir = upload_base_dir.split(base_dir)[1].strip('/')
+    gdrive_dir = upload_base_dir.partition(base_dir)[2].strip('/')
     logger.info(f'Moving file to temporary path: {cloud_temp_path}')
     os.makedirs(cloud_temp_path)
     if config.SHOULD_DELETE:
@@ -101,8 +102,9 @@ def upload_video(file_path):
     while return_code != 0 and upload_tries < config.MAX_UPLOAD_TRIES:
         logger.info('Uploading file...')
         upload_tries += 1
-        return_code = subprocess.call(f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} copyto '
-                                      f'"{upload_base_dir}" "GDrive:{gdrive_dir}"', shell=True)
+        return_code = subprocess.run(
+            [config.RCLONE_PATH, '--config', config.RCLONE_CONFIG_PATH, 'copyto', *config.RCLONE_UPLOAD_FLAGS,
+             upload_base_dir, f'GDrive:{gdrive_dir}'], check=False).returncode
         # Check results.
         if return_code != 0:
             logger.error(f'Bad return code ({return_code}) for file: {file_name}')
@@ -123,7 +125,7 @@ def upload_video(file_path):
 
     # Unmount ENCFS directory.
     if config.SHOULD_ENCRYPT:
-        subprocess.call(f'{config.FUSERMOUNT_PATH} -u "{plain_base_dir}"', shell=True)
+        subprocess.run([config.FUSERMOUNT_PATH, '-u', plain_base_dir], check=False)
 
     # Delete all temporary directories.
     shutil.rmtree(base_dir)
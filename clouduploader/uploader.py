@@ -1,4 +1,5 @@
 #!/usr/local/bin/python3
+from functools import lru_cache
 import os
 import random
 import shutil
@@ -54,8 +55,9 @@ def _encrypt(encrypted_dir, plain_dir):
 
     # Encrypt!
     os.makedirs(encrypted_dir)
-    return_code = subprocess.call(
-        f'echo {config.ENCFS_PASSWORD} | {config.ENCFS_PATH} -S "{encrypted_dir}" "{plain_dir}"', shell=True)
+    return_code = subprocess.run(
+        [config.ENCFS_PATH, '-S', encrypted_dir, plain_dir], input=f'{config.ENCFS_PASSWORD}\n', text=True,
+        check=False).returncode
 
     if return_code != 0:
         logger.error(f'Bad return code ({return_code}) for encryption. Stopping!')
@@ -112,6 +114,18 @@ def _extract_masterclass_path(file_name):
     return cloud_dir, cloud_file
 
 
+@lru_cache(maxsize=1024)
+def format_show_title(title):
+    """
+    Translate the given show title to its best known name.
+    Results are cached, since many episodes share the same show.
+
+    :param title: The show title to translate.
+    :return: The translated show title.
+    """
+    return format_show(title)
+
+
 def guess_path(file_name):
     """
     Guess cloud dir and cloud file name from the given file name.
@@ -132,7 +146,7 @@ def guess_path(file_name):
 
     if video_type == 'episode' and title:
         # Translate show title if needed.
-        title = format_show(title)
+        title = format_show_title(title)
         season = guess_results.get('season')
 
         # Skip rare cases of weird episodes names.
@@ -142,13 +156,13 @@ def guess_path(file_name):
             if episode:
                 # Dirs that end with . are evil!
                 fixed_dir_name = title.rstrip('.')
-                cloud_dir = os.path.join(config.CLOUD_TV_PATH, fixed_dir_name, 'Season {:02d}'.format(season))
+                cloud_dir = os.path.join(config.CLOUD_TV_PATH, fixed_dir_name, f'Season {season:02d}')
 
                 if isinstance(episode, list):
-                    episode_str = 'E{:02d}-E{:02d}'.format(episode[0], episode[-1])
+                    episode_str = f'E{episode[0]:02d}-E{episode[-1]:02d}'
                 else:
-                    episode_str = 'E{:02d}'.format(episode)
-                cloud_file = '{} - S{:02d}{}'.format(title, season, episode_str)
+                    episode_str = f'E{episode:02d}'
+                cloud_file = f'{title} - S{season:02d}{episode_str}'
 
     elif video_type == 'movie' and title:
         # Make sure every word starts with a capital letter.
@@ -162,29 +176,113 @@ def guess_path(file_name):
     return cloud_dir, cloud_file
 
 
-def upload_file(file_path):
+def _rclone_copyto(source_path, gdrive_path):
     """
-    Upload the given file to its proper Google Drive cloud directory.
+    Copy the given local path to the given Google Drive path using rclone.
 
-    :param: file_path: The file to upload.
+    :param source_path: The local file or directory to copy.
+    :param gdrive_path: The destination path in Google Drive.
+    :return: True if succeeded, and False otherwise.
+    """
+    upload_tries = 0
+    while upload_tries < config.MAX_UPLOAD_TRIES:
+        logger.info('Uploading file...')
+        upload_tries += 1
+        process_result = subprocess.run(
+            [config.RCLONE_PATH, '--config', config.RCLONE_CONFIG_PATH, 'copyto', '--update',
+             *config.RCLONE_UPLOAD_FLAGS, source_path, f'GDrive:{gdrive_path}'],
+            text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+        # Check results.
+        return_code = process_result.returncode
+        if return_code == 0:
+            return True
+        logger.error(f'Bad return code ({return_code}) for path: {source_path}. Output:\n{process_result.stdout}')
+        if upload_tries < config.MAX_UPLOAD_TRIES:
+            logger.info('Trying again!')
+    logger.error('Max retries with no success! Skipping...')
+    return False
+
+
+def _upload_encrypted(files_list):
+    """
+    Upload the given files to their cloud paths, encrypted using a single temporary encfs directory tree.
+
+    :param files_list: A list of tuples of format (file_path, cloud_dir, cloud_file).
+    :return: True if succeeded, and False otherwise.
+    """
+    # Create a temporary random cloud dir structure.
+    original_dir = os.path.dirname(files_list[0][0])
+    random_dir_name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+    base_dir = os.path.join(original_dir, random_dir_name)
+    plain_base_dir = os.path.join(base_dir, config.CLOUD_PLAIN_PATH)
+    os.makedirs(plain_base_dir)
+    encrypted_base_dir = os.path.join(base_dir, config.CLOUD_ENCRYPTED_PATH)
+    encryption_successful = _encrypt(encrypted_base_dir, plain_base_dir)
+    if not encryption_successful:
+        # Delete directories and stop.
+        shutil.rmtree(base_dir)
+        return False
+    is_uploaded = False
+    is_restored = True
+    final_paths = []
+    try:
+        for file_path, cloud_dir, cloud_file in files_list:
+            cloud_temp_path = os.path.join(plain_base_dir, cloud_dir)
+            final_file_path = os.path.join(cloud_temp_path, cloud_file)
+            logger.info(f'Moving file to temporary path: {cloud_temp_path}')
+            os.makedirs(cloud_temp_path, exist_ok=True)
+            if config.SHOULD_DELETE:
+                shutil.move(file_path, final_file_path)
+            else:
+                shutil.copy(file_path, final_file_path)
+            final_paths.append((file_path, final_file_path))
+
+        # Upload the encrypted directory tree (all files at once).
+        is_uploaded = _rclone_copyto(encrypted_base_dir, config.CLOUD_ENCRYPTED_PATH)
+    finally:
+        if not is_uploaded:
+            # Reverse everything.
+            logger.info('Upload failed! Reversing all changes...')
+            if config.SHOULD_DELETE:
+                for file_path, final_file_path in final_paths:
+                    try:
+                        shutil.move(final_file_path, file_path)
+                    except OSError:
+                        logger.exception(f'Failed to restore file: {file_path}')
+                        is_restored = False
+        # Unmount ENCFS directory.
+        subprocess.run([config.FUSERMOUNT_PATH, '-u', plain_base_dir], check=False)
+        # Delete all temporary directories (unless they still hold files that couldn't be restored).
+        if is_restored:
+            shutil.rmtree(base_dir)
+        else:
+            logger.error(f'Keeping temporary directory with unrestored files: {base_dir}')
+    return is_uploaded
+
+
+def _get_cloud_path(file_path):
+    """
+    Guess the cloud dir and cloud file name for the given file.
+
+    :param: file_path: The file to guess on.
+    :return: A tuple of format (cloud_dir, cloud_file, is_subtitles), or None if the file should be skipped.
     """
-    logger.info(f'Uploading file: {file_path}')
     fixed_file_path = file_path
     file_parts = os.path.splitext(file_path)
 
     # Verify file name.
     if len(file_parts) != 2:
         logger.info('File has no extension! Skipping...')
-        return
+        return None
     file_name, file_extension = file_parts
     file_extension = file_extension.lower()
     if file_extension not in EXTENSIONS_WHITE_LIST:
         logger.info('File extension is not in white list! Skipping...')
-        return
+        return None
     for black_list_word in NAMES_BLACK_LIST:
         if black_list_word in file_name.lower():
             logger.info(f'File name contains a black listed word ({black_list_word})! Skipping...')
-            return
+            return None
     language_extension = None
     is_subtitles = file_extension in SUBTITLES_EXTENSIONS
 
@@ -203,7 +301,7 @@ def upload_file(file_path):
     fixed_file_name = os.path.basename(fixed_file_path)
     # Remove brackets group name prefix.
     if fixed_file_name.startswith('[') and ']' in fixed_file_name:
-        fixed_file_name = fixed_file_name.split(']', 1)[1]
+        fixed_file_name = fixed_file_name.partition(']')[2]
 
     # Check if dubbed.
     is_kids = 'hebdub' in fixed_file_name.lower() or 'hebdub' in fixed_file_path.lower() or \
@@ -226,72 +324,65 @@ def upload_file(file_path):
 
         cloud_file += file_extension
         logger.info('Cloud path: {}'.format(os.path.join(cloud_dir, cloud_file)))
-        # Create a temporary random cloud dir structure.
-        original_dir = os.path.dirname(file_path)
-        random_dir_name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
-        base_dir = os.path.join(original_dir, random_dir_name)
-        plain_base_dir = os.path.join(base_dir, config.CLOUD_PLAIN_PATH)
-        os.makedirs(plain_base_dir)
-        cloud_temp_path = os.path.join(plain_base_dir, cloud_dir)
-        final_file_path = os.path.join(cloud_temp_path, cloud_file)
-        # Use the plain directory when uploading, unless encryption is enabled.
-        upload_base_dir = plain_base_dir
-        # Set up encryption if needed.
-        if config.SHOULD_ENCRYPT:
-            encrypted_base_dir = os.path.join(base_dir, config.CLOUD_ENCRYPTED_PATH)
-            encryption_successful = _encrypt(encrypted_base_dir, plain_base_dir)
-            if not encryption_successful:
-                # Delete directories and stop.
-                shutil.rmtree(base_dir)
-                return
-            # Upload the encrypted directory tree instead of the plain one.
-            upload_base_dir = encrypted_base_dir
-        gdrive_dir = upload_base_dir.split(base_dir)[1].strip(os.path.sep)
-        logger.info(f'Moving file to temporary path: {cloud_temp_path}')
-        os.makedirs(cloud_temp_path)
-        if config.SHOULD_DELETE:
-            shutil.move(file_path, cloud_temp_path)
-        else:
-            shutil.copy(file_path, cloud_temp_path)
-        os.rename(os.path.join(cloud_temp_path, os.path.basename(file_path)), final_file_path)
-
-        # Upload!
-        upload_tries = 0
-        return_code = 1
-        while return_code != 0 and upload_tries < config.MAX_UPLOAD_TRIES:
-            logger.info('Uploading file...')
-            upload_tries += 1
-            process_result = subprocess.run(
-                f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} copyto --update "{upload_base_dir}" '
-                f'"GDrive:{gdrive_dir}"', shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                check=False)
-            # Check results.
-            return_code = process_result.returncode
-            if return_code != 0:
-                logger.error(
-                    f'Bad return code ({return_code}) for file: {cloud_file}. Output:\n{process_result.stdout}')
-                if upload_tries < config.MAX_UPLOAD_TRIES:
-                    logger.info('Trying again!')
-                else:
-                    logger.error('Max retries with no success! Skipping...')
-        # If everything went smoothly, add the file name to the original names log.
-        if return_code == 0:
-            logger.info('Upload succeeded! Deleting original file...')
-            if not is_subtitles:
-                open(config.ORIGINAL_NAMES_LOG, 'a', encoding='UTF-8').write(file_path + '\n')
-        else:
-            # Reverse everything.
-            logger.info('Upload failed! Reversing all changes...')
-            if config.SHOULD_DELETE:
-                shutil.move(final_file_path, original_dir)
-                os.rename(os.path.join(original_dir, cloud_file), file_path)
-        # Unmount ENCFS directory.
-        if config.SHOULD_ENCRYPT:
-            subprocess.call(f'{config.FUSERMOUNT_PATH} -u "{plain_base_dir}"', shell=True)
-        # Delete all temporary directories.
-        shutil.rmtree(base_dir)
+        return cloud_dir, cloud_file, is_subtitles
+
+    logger.info('Couldn\'t guess file info. Skipping...')
+    return None
+
+
+def upload_files(file_paths):
+    """
+    Upload the given files to their proper Google Drive cloud directories.
+    When encryption is enabled, all files are uploaded together (with a single encfs mount and rclone call).
+
+    :param: file_paths: The files to upload.
+    """
+    files_list = []
+    cloud_paths = set()
+    for file_path in file_paths:
+        logger.info(f'Uploading file: {file_path}')
+        cloud_path = _get_cloud_path(file_path)
+        if not cloud_path:
+            continue
+        # Files are uploaded together, so each cloud path can only be used once.
+        if cloud_path[:2] in cloud_paths:
+            logger.info('Another file is already uploaded to the same cloud path! Skipping...')
+            continue
+        cloud_paths.add(cloud_path[:2])
+        files_list.append((file_path, *cloud_path))
+    if not files_list:
+        return
+
+    uploaded_files = []
+    if config.SHOULD_ENCRYPT:
+        if _upload_encrypted([current_file[:3] for current_file in files_list]):
+            uploaded_files = files_list
     else:
-        logger.info('Couldn\'t guess file info. Skipping...')
+        for current_file in files_list:
+            file_path, cloud_dir, cloud_file, _ = current_file
+            # Without encryption, rclone can upload the file straight to its cloud path (no local copy is needed).
+            if _rclone_copyto(file_path, os.path.join(config.CLOUD_PLAIN_PATH, cloud_dir, cloud_file)):
+                uploaded_files.append(current_file)
+                if config.SHOULD_DELETE:
+                    logger.info(f'Deleting original file: {file_path}')
+                    os.remove(file_path)
+
+    # If everything went smoothly, add the file names to the original names log.
+    if uploaded_files:
+        logger.info('Upload succeeded!')
+        with open(config.ORIGINAL_NAMES_LOG, 'a', encoding='UTF-8') as original_names_file:
+            for file_path, _, _, is_subtitles in uploaded_files:
+                if not is_subtitles:
+                    original_names_file.write(file_path + '\n')
+
+
+def upload_file(file_path):
+    """
+    Upload the given file to its proper Google Drive cloud directory.
+
+    :param: file_path: The file to upload.
+    """
+    upload_files([file_path])
 
 
 def main():